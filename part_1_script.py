@@ -1,7 +1,15 @@
+import functools
+import hashlib
+import itertools
+import os
+import numpy
+import orjson
 import pandas
-from pandas_datareader import wb
+import requests
 import matplotlib
-import matplotlib.pyplot as plt
+import matplotlib.artist
+import matplotlib.figure
+import matplotlib.backends.backend_pdf
 import matplotlib.colors
 import matplotlib.cm
 import matplotlib.font_manager
@@ -15,43 +23,107 @@ import matplotlib.font_manager
 # should be added, and layout positions calculated relative to size of text, graph and formatting elements.
 
 # Set up font properties and colors for title, legend and axis labels
-font_prop = matplotlib.font_manager.FontProperties()
-font_prop.set_size(8)
+font_prop = matplotlib.font_manager.FontProperties(family='sans-serif', size=8)
 font_color = '#a2a2a2'  # light gray
 title_color = '#7f7f7f' # dark gray
 matplotlib.rcParams['font.sans-serif'] = 'Verdana'
 matplotlib.rcParams['font.family'] = 'sans-serif'
+# Embed subsetted TrueType fonts and compress the PDF output
+matplotlib.rcParams['pdf.fonttype'] = 42
+matplotlib.rcParams['pdf.compression'] = 9
+
+# Files read and written by this script are kept relative to the script, not the current directory
+script_dir = os.path.dirname(os.path.abspath(__file__))
+# Downloaded data is cached on disk as Parquet files, one per set of download arguments
+cache_dir = os.path.join(script_dir, '.cache', 'worldbank')
+# Version of the cached data format, included in the cache key. Increase it whenever download_data changes what it
+# returns (e.g. column dtypes), so that files cached by earlier versions are not used.
+cache_version = 2
+# Snapshot of the life expectancy data used by main(), committed in the data directory next to this script.
+# Historical World Bank data does not change, so the snapshot is read rather than downloading the data on every run.
+# The indicators, countries and years it holds are stored with it, in the Parquet metadata.
+snapshot_path = os.path.join(script_dir, 'data', 'life_expectancy.parquet')
+# Set WB_REFRESH=1 in the environment to ignore the snapshot and cache, download the data again and update both.
+# This is the only way the snapshot is written.
+refresh = os.environ.get('WB_REFRESH') == '1'
+
+# Return the cache file path for a set of download arguments. The path is the SHA1 hash of the
+# arguments and cache format version, so the same indicators, countries and years always map to
+# the same file for a given version.
+@functools.lru_cache()
+def cache_path(ind, country, st_yr, end_yr):
+    key = repr((cache_version, ind, country, st_yr, end_yr)).encode('utf-8')
+    return os.path.join(cache_dir, hashlib.sha1(key).hexdigest() + '.parquet')
+
+# World Bank API (v2) endpoint, formatted with the country codes and indicator codes
+wb_api_url = 'https://api.worldbank.org/v2/country/{0}/indicator/{1}'
+
+# Download the indicator(s) for the specified country/countries and start/end years in a single
+# request, as a DataFrame indexed by country name and year with one column per indicator. The API
+# returns several indicators in one response when their codes are separated by semicolons and the
+# source database is given. All observations are requested in a single page, but any further pages
+# are also fetched if the API returns more observations than fit in one page.
+def fetch_indicators(session, ind, country, st_yr, end_yr):
+    url = wb_api_url.format(';'.join(country), ';'.join(ind))
+    params = {'format': 'json', 'source': 2, 'per_page': 20000 * len(ind),
+              'date': '{0}:{1}'.format(st_yr, end_yr)}
+    records = []
+    page, pages = 1, 1
+    while page <= pages:
+        response = session.get(url, params=dict(params, page=page))
+        response.raise_for_status()
+        # The response is a [page information, observations] pair, or a single message if the request failed
+        content = orjson.loads(response.content)
+        if 'message' in content[0]:
+            raise ValueError('World Bank API error: {0}'.format(content[0]['message']))
+        pages = int(content[0]['pages'])
+        records.extend(content[1] or [])
+        page += 1
+    # Build the index directly from the country, year and indicator arrays rather than row by row
+    index = pandas.MultiIndex.from_arrays([[r['country']['value'] for r in records],
+                                           [r['date'] for r in records],
+                                           [r['indicator']['id'] for r in records]],
+                                          names=['country', 'year', 'indicator'])
+    values = pandas.Series([r['value'] for r in records], index=index, dtype='float64')
+    return values.unstack(level='indicator').reindex(columns=list(ind)).rename_axis(columns=None)
 
 def download_data(ind, country, st_yr, end_yr):
+    # Return the cached copy of the data if it has already been downloaded
+    path = cache_path(tuple(ind), tuple(country), st_yr, end_yr)
+    if not refresh and os.path.exists(path):
+        return pandas.read_parquet(path, engine='pyarrow')
     # Download the indicator(s) for the specified country/countries and start/end years
-    # Uses the WorldBank data access extension to Pandas
-    dat = wb.download(indicator=ind, country=country, start=st_yr, end=end_yr)
+    with requests.Session() as session:
+        dat = fetch_indicators(session, ind, country, st_yr, end_yr)
+    # Life expectancy values are ages plotted to one decimal place, so single precision is plenty
+    # and halves the memory used by the processing and plotting that follows
+    dat = dat.astype('float32')
+    # Save the data to the cache, columnar and compressed, for subsequent runs
+    os.makedirs(cache_dir, exist_ok=True)
+    dat.to_parquet(path, engine='pyarrow', compression='zstd')
     return dat
 
 # Create a graph within a figure (which is returned), using the data provided.
-# X-axis data is specified by x_series, and y_series contains a list of column indices,
-# one per data series to be displayed on the graph. Labels for each data series are
-# provided in the labels list, and an optional title can be supplied.
-def plot_graph(data, x_series, y_series, labels, title=None):
+# X-axis data is specified by x_series, and y_data is a 2D array with one column per data
+# series to be displayed on the graph, in the same order as the labels. Labels for each data
+# series are provided in the labels list, and an optional title can be supplied.
+def plot_graph(x_series, y_data, labels, title=None):
     # Set up a color map for line colors. If more series than colors, repeat the colors.
     # Color codes obtained from Tableau 10 and Tableau 10 Medium color tables
     color_map = ['#e41a1c', '#f4a582', '#377eb8', '#92c5de', '#4daf4a', '#a6d96a', '#984ea3', '#c2a5cf']
-    while len(y_series) > len(color_map):
-        color_map = color_map.append(color_map)
-    colors = color_map[:len(y_series)]
+    colors = list(itertools.islice(itertools.cycle(color_map), len(labels)))
 
-    # Create the figure that will contain the graph and explanatory text
-    fig = plt.figure(figsize=(8,11), facecolor='w')
+    # Create the figure that will contain the graph and explanatory text. The figure is attached directly to a
+    # PDF canvas, as it is only ever saved to PDF, so no pyplot state or interactive backend is needed.
+    fig = matplotlib.figure.Figure(figsize=(8,11), facecolor='w')
+    matplotlib.backends.backend_pdf.FigureCanvasPdf(fig)
 
-    # Create the graph, and add each data series
+    # Create the graph, and add all data series in a single plot call - one column per series.
     ax = fig.add_subplot(111)
-    for s,l,c in zip(y_series, labels, colors):
-        # if series is not grouped by two variables (e.g. Income Group and Sex) then don't need to double index.
-        if isinstance(s, str):
-            ax.plot(x_series, data[s], label=l, color=c)
-        else:
-            # This example uses this as data is grouped by Income Group and Sex
-            ax.plot(x_series, data[s[0]][s[1]], label=l, color=c)
+    lines = ax.plot(x_series, y_data)
+    for ln,l,c in zip(lines, labels, colors):
+        ln.set_label(l)
+        ln.set_color(c)
 
     # Set the graph title if supplied
     if title is not None:
@@ -72,7 +144,7 @@ def plot_graph(data, x_series, y_series, labels, title=None):
     # Format axes - no right or top axis lines or ticks, ticks outside the axes, x-axis labels rotated for
     # easier reading.
     ax.tick_params(right='off', top='off', direction='out', colors=font_color, labelsize=12)
-    plt.xticks(rotation=60)
+    ax.tick_params(axis='x', labelrotation=60)
     ax.spines['right'].set_visible(False)
     ax.spines['top'].set_visible(False)
     ax.spines['left'].set_color(font_color)
@@ -81,11 +153,11 @@ def plot_graph(data, x_series, y_series, labels, title=None):
     # Create a legend below the graph with no frame, two columns and set text color.
     legend = ax.legend(bbox_to_anchor=(0.5, -0.2), loc='upper center',
                        prop=font_prop, frameon=False, ncol=2)
-    plt.setp(legend.get_title(), color=title_color)
-    plt.setp(legend.get_texts(), color=title_color)
+    matplotlib.artist.setp(legend.get_title(), color=title_color)
+    matplotlib.artist.setp(legend.get_texts(), color=title_color)
 
     # Adjust the location and size of the graph
-    plt.subplots_adjust(top=0.6, left=0.1, right=0.9, bottom=0.2)
+    fig.subplots_adjust(top=0.6, left=0.1, right=0.9, bottom=0.2)
 
     # Return the created figure
     return fig
@@ -94,7 +166,23 @@ def plot_graph(data, x_series, y_series, labels, title=None):
 def main():
     # Specify the Life Expectancy indicators (male and female) and download data for all countries between 1960 and now
     indicators = ['SP.DYN.LE00.MA.IN', 'SP.DYN.LE00.FE.IN']
-    life_exp = download_data(indicators, ['all'], 1960, 2018)
+    countries = ['all']
+    st_yr, end_yr = 1960, 2018
+    snapshot_key = {'indicators': indicators, 'countries': countries, 'years': [st_yr, end_yr]}
+    # Read the snapshot of this data, memory-mapping the file rather than reading it into a buffer, if it holds the
+    # same indicators, countries and years. Otherwise download the data (or read it from the cache).
+    life_exp = None
+    if not refresh and os.path.exists(snapshot_path):
+        life_exp = pandas.read_parquet(snapshot_path, engine='pyarrow', memory_map=True)
+        if life_exp.attrs != snapshot_key:
+            life_exp = None
+    if life_exp is None:
+        life_exp = download_data(indicators, countries, st_yr, end_yr)
+    # Update the snapshot from the freshly downloaded data if a refresh was requested
+    if refresh:
+        life_exp.attrs = snapshot_key
+        os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
+        life_exp.to_parquet(snapshot_path, engine='pyarrow', compression='zstd')
 
     # World Bank specifies Income Groups containing countries with economies whose GNI per capita fits within specific
     # thresholds. These groups are already contained within the 'all countries' dataset, so average values do not need
@@ -102,17 +190,30 @@ def main():
     # 'Upper middle income economies' and 'High income economies'.
     # Extract the income groups data from the dataset of all countries
     income_groups = [u'Low income', u'Lower middle income', u'Upper middle income', u'High income']
-    life_exp_income = life_exp.select(lambda x: x[0] in income_groups)
+    mask = life_exp.index.get_level_values('country').isin(income_groups)
+    life_exp_income = life_exp.loc[mask]
 
-    # Rename indicators with more meaningful names, and unstack to index by year rather than country
     col_names = {'SP.DYN.LE00.MA.IN' : 'Male', 'SP.DYN.LE00.FE.IN' : 'Female'}
-    life_exp_income = life_exp_income.rename(columns=col_names).unstack(level=0)
-    # Swap column grouping to:
+    # Rename indicators with more meaningful names, and index by year rather than country with columns grouped
+    # by Income Group and Sex, e.g.:
     #   Low Income  | Lower Middle Income | Upper Middle Income |  High Income  |
     # Female | Male |   Female  |  Male   |  Female   |  Male   | Female | Male |
     #
-    life_exp_income = life_exp_income.swaplevel(0, 1, axis=1)
-    life_exp_income = life_exp_income.sortlevel(0, axis=1)
+    # The layout of the result is fixed by the income groups and sexes, so rather than unstacking, the values are
+    # scattered directly into a preallocated (year, Income Group & Sex) array, with the columns in the canonical
+    # order for display shown above. The integer year and income group codes of each row, and the position of each
+    # renamed indicator in the list of sexes, give its cell: column (group * number of sexes + sex) holds the series
+    # for that group and sex.
+    sexes = ['Female', 'Male']
+    life_exp_income = life_exp_income.rename(columns=col_names)
+    sex_idx = numpy.array([sexes.index(col) for col in life_exp_income.columns])
+    group_idx = life_exp_income.index.get_level_values('country').map(
+        {name: i for i, name in enumerate(income_groups)}).to_numpy()
+    year_idx, years = pandas.factorize(life_exp_income.index.get_level_values('year'), sort=True)
+    values = numpy.full((len(years), len(income_groups) * len(sexes)), numpy.nan, dtype=numpy.float32)
+    values[year_idx[:, None], group_idx[:, None] * len(sexes) + sex_idx] = life_exp_income.to_numpy()
+    life_exp_income = pandas.DataFrame(values, index=pandas.Index(years, name='year'),
+                                       columns=pandas.MultiIndex.from_product([income_groups, sexes]))
 
     # While individual countries may have missing data throughout the time-series, in the Income Groups dataset
     # missing data only exists where no data for any of the countries exists - i.e. in the years where no
@@ -127,17 +228,20 @@ def main():
     # been better to interpolate values to fill in the missing data. If some of the income groups had missing data
     # at the start or end of the time-series, then the year range could have been adjusted to exclude the years
     # where full data was not available.
-    life_exp_income_clean = life_exp_income.dropna(how='all')
+    #
+    # As the missing rows only occur at the end of the time-series, truncate after the last year with any data
+    # rather than scanning every row for missing values.
+    life_exp_income_clean = life_exp_income.loc[:life_exp_income.last_valid_index()]
     last_year = life_exp_income_clean.tail(1).index.item()
 
     # Findings paragraph
-    paragraph = '''Time-series data of  male and  female life expectancy obtained from the World Bank World
+    paragraph = f'''Time-series data of  male and  female life expectancy obtained from the World Bank World
 Development Indicators dataset and  visualized by income  group shows life expectancy for
-both men and women has been steadily improving over the period 1960-{0}, irrespective
+both men and women has been steadily improving over the period 1960-{last_year}, irrespective
 of  income  group,  with  biggest  increases  in  Upper  Middle income  economies. Overall,
 income  group  has  a  very  strong  correlation  with  life  expectancy, with  high  income
 economies  showing  life  expectancies  almost  20 years  longer  than  low income economies
-for both men and women in {0}. This is an improvement over the situation in 1960, where
+for both men and women in {last_year}. This is an improvement over the situation in 1960, where
 the gap between men in high income economies and those in low income economies was 28
 years,  and  30 years  for  women.  Across  all  income  groups,  women  have  higher  life
 expectancy than men with more pronounced gaps in higher income economies, possibly due
@@ -145,33 +249,33 @@ to  better  maternal  mortality  rates.  Within  income  groups,  male  and  fem
 expectancy  growth  rates  appear  to  have  been similar since 1960,  as evidenced by the
 consistent  gaps  shown  between  men and  women in all  groups  other than  Lower Middle
 income  economies  in  the graph below. In this income group, the  gap in  life expectancy
-between  men and  women is  slowly  widening,  from 1.3 years  in 1960 to 3.7 years in {0}.
+between  men and  women is  slowly  widening,  from 1.3 years  in 1960 to 3.7 years in {last_year}.
 This potentially shows the impact of slowly improving maternal healthcare in these economies.
-'''.format(last_year)
+'''
 
     # Setup data for plotting. The graph will plot a time-series of Life Expectancies for Male and Female for each
-    # of the four Income Groups. So there will be 8 y-series provided with corresponding labels.
-    series_data = [('Low income','Female'), ('Low income','Male'),
-                   ('Lower middle income','Female'), ('Lower middle income','Male'),
-                   ('Upper middle income','Female'), ('Upper middle income','Male'),
-                   ('High income','Female'), ('High income','Male')]
+    # of the four Income Groups. So there will be 8 y-series, one per column of life_exp_income_clean, provided
+    # with corresponding labels.
     series_labels = ['Low income economies (female)', 'Low income economies (male)',
                      'Lower middle income economies (female)', 'Lower middle income economies (male)',
                      'Upper middle income economies (female)', 'Upper middle income economies (male)',
                      'High income economies (female)', 'High income economies (male)']
     # Title for document.
-    ttl = 'Trends in Life Expectancy, 1960-{0}'.format(last_year)
+    ttl = f'Trends in Life Expectancy, 1960-{last_year}'
     # Generate the graph
-    graph_title = 'Life Expectancy by Income Group, 1960-{0}'.format(last_year)
-    fig = plot_graph(life_exp_income_clean, life_exp_income_clean.index, series_data, series_labels, graph_title)
-    plt.suptitle(ttl, y=0.95, fontsize=20)
+    graph_title = f'Life Expectancy by Income Group, 1960-{last_year}'
+    # The columns are already in plotting order, so the graph can plot all the series as a single array.
+    # The array is laid out column-major so that the values of each series are contiguous in memory.
+    y_data = numpy.asfortranarray(life_exp_income_clean.to_numpy(dtype=numpy.float32))
+    fig = plot_graph(life_exp_income_clean.index, y_data, series_labels, graph_title)
+    fig.suptitle(ttl, y=0.95, fontsize=20)
     # Add the paragraph text
     fig.text(0.1, 0.90, paragraph, ha='left', va='top', fontsize=10)
     # Add source information
     fig.text(0.2, 0.03, 'Source: World Development Indicators, The World Bank', color=title_color, size=8)
-    # Save the output as a PDF file
-    fig.savefig('part_1_output.pdf')
-    plt.close()
+    # Save the output as a PDF file. The page keeps the figure size, as the layout is positioned relative to it.
+    with matplotlib.backends.backend_pdf.PdfPages(os.path.join(script_dir, 'part_1_output.pdf'), metadata={}) as pdf:
+        pdf.savefig(fig)
     return None
 
 if __name__ == '__main__':